@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+"""
+Benchmark the tree stages of sushichef.py on synthetic trees that are
+`multiplier` times wider and `depth` levels deeper than the trees in
+chefdata/trees. Network access (Box.com, Vimeo, unoconv) is replaced by offline
+fakes that write tiny files, so only the tree walking, file handling and JSON
+serialization costs are measured.
+
+Run this script from the root of the chef repo using:
+    ./bench_tree_stages.py --multipliers 10 100 1000 --depths 0 50
+    ./bench_tree_stages.py --compare {other_commit}
+"""
+import argparse
+import copy
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+import sushichef  # noqa: E402  (sushichef reads credentials relative to repo root)
+
+
+BENCHMARKS_DIR = "chefdata/benchmarks"
+FIXTURES = [
+    sushichef.CRAWLING_STAGE_OUTPUT,
+    sushichef.SCRAPING_STAGE_OUTPUT,
+    sushichef.TRANSFORMED_STAGE_OUTPUT,
+    "chefdata/trees/ricecooker_json_tree.json",
+]
+FAKE_PDF_CONTENTS = b"%PDF-1.4\n%%EOF\n"
+
+
+# SYNTHETIC TREES
+################################################################################
+
+
+def get_stable_hash(text):
+    return int(hashlib.md5(text.encode("utf-8")).hexdigest(), 16)
+
+
+def copy_subtree(subtree, copy_index):
+    """
+    Return a deep copy of `subtree` where titles, urls and ids are made unique
+    by adding `copy_index` to them, so copies don't get deduplicated.
+    """
+    subtree = copy.deepcopy(subtree)
+    stack = [subtree]
+    while stack:
+        node = stack.pop()
+        if copy_index > 0:
+            # prefix titles since scrape_shls looks at their endings
+            prefix = "({}) ".format(copy_index)
+            for key in ["title", "source_id"]:
+                if key in node:
+                    node[key] = prefix + node[key]
+            for key in ["url", "web_url"]:
+                if key in node:
+                    node[key] = node[key] + "#copy{}".format(copy_index)
+        stack.extend(node.get("children", []))
+    return subtree
+
+
+def synthesize_tree(tree, multiplier, depth):
+    """
+    Return a tree whose top-level children are repeated `multiplier` times,
+    each copy nested inside a chain of `depth` topic-like folders.
+    """
+    synthetic_tree = {key: value for key, value in tree.items() if key != "children"}
+    synthetic_tree["children"] = []
+    for copy_index in range(multiplier):
+        for child in tree["children"]:
+            node = copy_subtree(child, copy_index)
+            for level in range(depth):
+                node = dict(
+                    kind="shls_extras",
+                    title="Level {} folder".format(level),
+                    children=[node],
+                )
+            synthetic_tree["children"].append(node)
+    return synthetic_tree
+
+
+def count_nodes(tree):
+    count = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.get("children", []))
+    return count
+
+
+# OFFLINE FAKES
+################################################################################
+
+
+def fake_get_shared_item(shared_link):
+    link_hash = get_stable_hash(shared_link)
+    if link_hash % 5 == 0:
+        return "folder", str(link_hash % 10 ** 10), None
+    return "file", None, str(link_hash % 10 ** 10)
+
+
+def fake_box_download_file(file_id, shared_link, destdir=None):
+    ext = ".docx" if get_stable_hash(file_id) % 4 == 0 else ".pdf"
+    out_path = os.path.join(destdir, file_id + ext)
+    with open(out_path, "wb") as outf:
+        outf.write(FAKE_PDF_CONTENTS)
+    return out_path
+
+
+def fake_box_download_folder(folder_id, shared_link, destdir=None):
+    folder_path = os.path.join(destdir, folder_id)
+    os.makedirs(folder_path, exist_ok=True)
+    folder_dict = dict(
+        title=folder_id, source_id="box_folder:" + folder_id, children=[]
+    )
+    for i in range(3):
+        file_id = "{}{}".format(folder_id, i)
+        file_path = fake_box_download_file(file_id, shared_link, destdir=folder_path)
+        file_dict = dict(
+            title=os.path.basename(file_path),
+            kind="shls_link",
+            path=file_path,
+            source_id="box_file:" + file_id,
+        )
+        folder_dict["children"].append(file_dict)
+    return folder_dict
+
+
+def fake_download_vimeo_playlist(playlist_url, title):
+    playlist_dict = dict(kind="vimeo_playlist", title=title, children=[])
+    for i in range(10):
+        video_dict = dict(
+            kind="vimeo_video",
+            title="{} video {}".format(title, i),
+            web_url="{}/{}".format(playlist_url, i),
+            thumbnail=None,
+            playlist_index=i + 1,
+        )
+        playlist_dict["children"].append(video_dict)
+    return playlist_dict
+
+
+def fake_convert_file_to_pdf(path, dest_path):
+    with open(dest_path, "wb") as outf:
+        outf.write(FAKE_PDF_CONTENTS)
+
+
+def install_fakes():
+    sushichef.get_shared_item = fake_get_shared_item
+    sushichef.box_download_file = fake_box_download_file
+    sushichef.box_download_folder = fake_box_download_folder
+    sushichef.download_vimeo_playlist = fake_download_vimeo_playlist
+    sushichef.convert_file_to_pdf = fake_convert_file_to_pdf
+    # logging would dominate the timings (and some log calls are malformed)
+    logging.getLogger(sushichef.__name__).setLevel(logging.WARNING)
+
+
+# MEASUREMENT
+################################################################################
+
+
+def measure(func, repeat):
+    """
+    Call `func` `repeat` times and return (best_seconds, peak_mb), measuring
+    the peak traced memory in an extra run so it doesn't skew the timings.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak / 1024.0 / 1024.0
+
+
+def measure_stages(stages, repeat):
+    """
+    Measure the (stage, func) pairs in order and return {stage: (seconds, peak_mb)}.
+    When a stage hits the recursion limit, it and the stages after it, which
+    need its output, are recorded as (None, None).
+    """
+    results = {}
+    failed = False
+    for stage, func in stages:
+        if not failed:
+            try:
+                results[stage] = measure(func, repeat)
+                continue
+            except RecursionError:
+                logging.error("{} hit the recursion limit".format(stage))
+                failed = True
+        results[stage] = (None, None)
+    return results
+
+
+def run_stage_benchmarks(crawl_tree, workdir, repeat):
+    """
+    Run the scrape, transform and ricecookerify stages one after the other on
+    `crawl_tree` inside `workdir` and return a dict {stage: (seconds, peak_mb)}.
+    """
+    crawl_path = os.path.join(workdir, "crawl.json")
+    scrape_path = os.path.join(workdir, "scrape.json")
+    transform_path = os.path.join(workdir, "transform.json")
+    downloaded_dir = os.path.join(workdir, "downloaded")
+    transformed_dir = os.path.join(workdir, "transformed")
+    for dir in [downloaded_dir, transformed_dir]:
+        os.makedirs(dir, exist_ok=True)
+
+    def write_input():
+        with open(crawl_path, "w") as outf:
+            json.dump(crawl_tree, outf)
+
+    def scrape():
+        sushichef.scrape_shls(
+            input_path=crawl_path,
+            output_path=scrape_path,
+            downloaded_dir=downloaded_dir,
+        )
+
+    def transform():
+        sushichef.transform_local_files(
+            input_path=scrape_path,
+            output_path=transform_path,
+            downloaded_dir=downloaded_dir,
+            transformed_dir=transformed_dir,
+        )
+
+    def ricecookerify():
+        sushichef.create_ricecooker_json_tree({}, input_path=transform_path)
+
+    stages = [
+        ("scrape", scrape),
+        ("transform", transform),
+        ("ricecookerify", ricecookerify),
+    ]
+    try:
+        write_input()
+    except RecursionError:
+        logging.error("writing the crawl tree hit the recursion limit")
+        return {stage: (None, None) for stage, _ in stages}
+    return measure_stages(stages, repeat)
+
+
+def run_json_benchmarks(tree, workdir, repeat):
+    """
+    Return {stage: (seconds, peak_mb)} for dumping and loading `tree`.
+    """
+    json_path = os.path.join(workdir, "tree.json")
+
+    def json_dump():
+        with open(json_path, "w") as outf:
+            json.dump(tree, outf, indent=2)
+
+    def json_load():
+        with open(json_path, "r") as inf:
+            json.load(inf)
+
+    return measure_stages([("json_dump", json_dump), ("json_load", json_load)], repeat)
+
+
+def run_benchmarks(multipliers, depths, repeat):
+    fixtures = {}
+    for fixture in FIXTURES:
+        with open(fixture, "r") as inf:
+            fixtures[fixture] = json.load(inf)
+
+    results = []
+    for multiplier in multipliers:
+        for depth in depths:
+            logging.info(
+                "Benchmarking multiplier={} depth={}".format(multiplier, depth)
+            )
+            workdir = tempfile.mkdtemp(prefix="shls_bench_")
+            try:
+                for fixture, tree in fixtures.items():
+                    synthetic_tree = synthesize_tree(tree, multiplier, depth)
+                    if fixture == sushichef.CRAWLING_STAGE_OUTPUT:
+                        stage_results = run_stage_benchmarks(
+                            synthetic_tree, workdir, repeat
+                        )
+                    else:
+                        stage_results = {}
+                    stage_results.update(
+                        run_json_benchmarks(synthetic_tree, workdir, repeat)
+                    )
+                    for stage, (seconds, peak_mb) in stage_results.items():
+                        results.append(
+                            dict(
+                                fixture=os.path.basename(fixture),
+                                stage=stage,
+                                multiplier=multiplier,
+                                depth=depth,
+                                nodes=count_nodes(synthetic_tree),
+                                seconds=seconds,
+                                peak_mb=peak_mb,
+                            )
+                        )
+            finally:
+                shutil.rmtree(workdir)
+    return results
+
+
+# RESULTS
+################################################################################
+
+
+def get_commit():
+    try:
+        output = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+        )
+        return output.decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def get_result_key(result):
+    return (result["fixture"], result["stage"], result["multiplier"], result["depth"])
+
+
+def format_number(value, fmt):
+    return "-" if value is None else fmt.format(value)
+
+
+def print_results(results, baseline=None):
+    baseline_by_key = {}
+    if baseline:
+        baseline_by_key = {get_result_key(result): result for result in baseline}
+    print(
+        "{:38} {:14} {:>6} {:>5} {:>8} {:>10} {:>10} {:>8}".format(
+            "fixture", "stage", "mult", "depth", "nodes", "seconds", "peak_mb", "ratio"
+        )
+    )
+    for result in results:
+        ratio = None
+        base = baseline_by_key.get(get_result_key(result))
+        if base and base["seconds"] and result["seconds"]:
+            ratio = result["seconds"] / base["seconds"]
+        print(
+            "{:38} {:14} {:>6} {:>5} {:>8} {:>10} {:>10} {:>8}".format(
+                result["fixture"],
+                result["stage"],
+                result["multiplier"],
+                result["depth"],
+                result["nodes"],
+                format_number(result["seconds"], "{:.4f}"),
+                format_number(result["peak_mb"], "{:.2f}"),
+                format_number(ratio, "{:.2f}x"),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--multipliers", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--depths", type=int, nargs="+", default=[0, 50])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--compare", metavar="COMMIT", help="show timings relative to COMMIT"
+    )
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(os.path.join(BENCHMARKS_DIR, args.compare + ".json"), "r") as inf:
+            baseline = json.load(inf)
+
+    install_fakes()
+    results = run_benchmarks(args.multipliers, args.depths, args.repeat)
+
+    os.makedirs(BENCHMARKS_DIR, exist_ok=True)
+    results_path = os.path.join(BENCHMARKS_DIR, get_commit() + ".json")
+    with open(results_path, "w") as outf:
+        json.dump(results, outf, indent=2)
+    print_results(results, baseline=baseline)
+    print("Saved results to {}".format(results_path))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
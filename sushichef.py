@@ -1,18 +1,25 @@
 #!/usr/bin/env python
 from bs4 import BeautifulSoup
 import cgi
+import collections
+import concurrent.futures
+import fcntl
+import hashlib
 import json
 import logging
 import os
 import re
 import requests
 import shutil
+import subprocess
 import sys
 import tempfile
+import threading
 import time
 import youtube_dl
 
 from le_utils.constants import licenses, content_kinds, file_types
+from PyPDF2 import PdfFileReader
 from ricecooker.chefs import JsonTreeChef
 from ricecooker.classes.licenses import get_license
 from ricecooker.utils.caching import (
@@ -36,9 +43,129 @@ setup_logging(level=logging.DEBUG if DEBUG else logging.INFO, error_log="errors.
 
 # BOX TOKEN
 #################################################################################
-# Need to get a new Developer Token  before running chef because expires after one hour
-# go to
-BOXAPI_DEVELOPER_TOKEN = open("credentials/box_com_access_token.txt").read().strip()
+# Developer Tokens expire after one hour, so for long runs put the app's OAuth 2.0
+# credentials in BOX_OAUTH_PATH and access tokens will be refreshed automatically
+BOX_TOKEN_PATH = "credentials/box_com_access_token.txt"
+BOX_OAUTH_PATH = "credentials/box_com_oauth.json"
+BOXAPI_TOKEN_URL = "https://api.box.com/oauth2/token"
+BOX_DEVELOPER_TOKEN_LIFETIME = 60 * 60
+BOX_TOKEN_REFRESH_MARGIN = 5 * 60  # refresh access tokens 5 min before they expire
+
+
+class BoxCredentials(object):
+    """
+    Provides Box.com API access tokens that are shared by all download workers.
+    When BOX_OAUTH_PATH exists, it must contain the app's `client_id` and
+    `client_secret` plus either a `refresh_token` (OAuth 2.0 user auth) or
+    `box_subject_type` and `box_subject_id` (server auth, client credentials
+    grant). New access tokens and rotated refresh tokens are written back to
+    it under a file lock, so chef processes running in parallel on the same
+    machine share them; runs spread over several machines need server auth.
+    Otherwise the Developer Token in BOX_TOKEN_PATH is used, and it is read
+    again when it gets rejected so it can be replaced during a run.
+    """
+
+    def __init__(self, token_path=BOX_TOKEN_PATH, oauth_path=BOX_OAUTH_PATH):
+        self.token_path = token_path
+        self.oauth_path = oauth_path
+        self.lock = threading.Lock()
+        self.access_token = None
+        self.expires_at = 0
+        self.rejected_token = None
+
+    def get_token(self):
+        with self.lock:
+            if time.time() > self.expires_at - BOX_TOKEN_REFRESH_MARGIN:
+                if os.path.exists(self.oauth_path):
+                    self.refresh_oauth_token()
+                else:
+                    self.read_developer_token()
+            return self.access_token
+
+    def invalidate(self, access_token):
+        """
+        Mark `access_token` as rejected by Box.com, unless another worker
+        already replaced it, so the next call to `get_token` refreshes it.
+        """
+        with self.lock:
+            if access_token == self.access_token:
+                self.rejected_token = access_token
+                self.expires_at = 0
+
+    def read_developer_token(self):
+        with open(self.token_path, "r") as inf:
+            self.access_token = inf.read().strip()
+        token_mtime = os.path.getmtime(self.token_path)
+        self.expires_at = token_mtime + BOX_DEVELOPER_TOKEN_LIFETIME
+        if self.expires_at < time.time():
+            logger.warning(
+                "Box.com Developer Token in {} is probably expired".format(
+                    self.token_path
+                )
+            )
+            # don't re-read the file for every request
+            self.expires_at = time.time() + BOX_TOKEN_REFRESH_MARGIN + 60
+
+    def refresh_oauth_token(self):
+        with open(self.oauth_path, "r+") as oauthf:
+            fcntl.flock(oauthf, fcntl.LOCK_EX)
+            config = json.load(oauthf)
+
+            # use the token saved by another process if it's still good
+            access_token = config.get("access_token")
+            expires_at = config.get("expires_at", 0)
+            if (
+                access_token
+                and access_token != self.rejected_token
+                and time.time() < expires_at - BOX_TOKEN_REFRESH_MARGIN
+            ):
+                self.access_token, self.expires_at = access_token, expires_at
+                return
+
+            data = dict(
+                client_id=config["client_id"], client_secret=config["client_secret"],
+            )
+            if "refresh_token" in config:
+                data.update(
+                    grant_type="refresh_token", refresh_token=config["refresh_token"]
+                )
+            else:
+                data.update(
+                    grant_type="client_credentials",
+                    box_subject_type=config["box_subject_type"],
+                    box_subject_id=config["box_subject_id"],
+                )
+            logger.info("Refreshing Box.com access token")
+            response = requests.post(BOXAPI_TOKEN_URL, data=data, timeout=60)
+            if "refresh_token" in config and "invalid_grant" in response.text:
+                raise BoxAuthenticationError(
+                    "Box.com refresh token in {} was rejected (invalid_grant). "
+                    "Refresh tokens can only be used once, so if chef runs on "
+                    "several machines share a copy of it, the first refresh "
+                    "invalidates the others; use server auth (box_subject_type "
+                    "and box_subject_id) for multi-node runs.".format(self.oauth_path)
+                )
+            if response.status_code != 200:
+                raise BoxAuthenticationError(
+                    "Could not refresh Box.com access token: {} {}".format(
+                        response.status_code, response.text
+                    )
+                )
+            token_data = response.json()
+            config["access_token"] = token_data["access_token"]
+            config["expires_at"] = time.time() + token_data["expires_in"]
+            if "refresh_token" in token_data:
+                config["refresh_token"] = token_data["refresh_token"]
+            oauthf.seek(0)
+            json.dump(config, oauthf, indent=2)
+            oauthf.truncate()
+
+        self.access_token = config["access_token"]
+        self.expires_at = config["expires_at"]
+        self.rejected_token = None
+
+
+BOX_CREDENTIALS = BoxCredentials()
 
 
 UNOCONV_SERVICE_URL = os.environ.get(
@@ -91,6 +218,14 @@ class NotFoundResource(Exception):
     pass
 
 
+class BoxAuthenticationError(Exception):
+    pass
+
+
+class PreflightError(Exception):
+    pass
+
+
 # HELPER METHODS
 ################################################################################
 
@@ -149,6 +284,168 @@ def get_text(element):
         return element.get_text().replace("\r", "").replace("\n", " ").strip()
 
 
+def get_file_hash(path):
+    """
+    Return the sha256 hex digest of the contents of the file at `path`.
+    """
+    hasher = hashlib.sha256()
+    with open(path, "rb") as inf:
+        for chunk in iter(lambda: inf.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+# TREE WALKING
+################################################################################
+
+
+def iter_tree(root):
+    """
+    Yield (parent, node) for all nodes in the tree `root` in pre-order, using an
+    explicit stack so deeply nested trees don't hit the recursion limit.
+    """
+    stack = [(None, root)]
+    while stack:
+        parent, node = stack.pop()
+        yield parent, node
+        for child in reversed(node.get("children", [])):
+            stack.append((node, child))
+
+
+class InlineExecutor(object):
+    """
+    Executor-like object that runs each call immediately in the calling thread.
+    """
+
+    def __init__(self, max_workers=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+TREE_WALK_EXECUTORS = {
+    "inline": InlineExecutor,
+    "thread": concurrent.futures.ThreadPoolExecutor,
+    "process": concurrent.futures.ProcessPoolExecutor,
+}
+
+
+def get_kind(node):
+    return node.get("kind")
+
+
+def copy_topic_node(node):
+    return dict(node)
+
+
+class TreeStage(object):
+    """
+    Iterative tree walker used by the scrape, transform and load stages.
+    Handlers are registered for the keys returned by `get_key` (the node kind):
+      - leaf handlers take a node (plus the keyword args passed to `run`) and
+        return the list of nodes that replace it, or [] to drop it
+      - topic handlers take a node and return the output node that the
+        results for its children get attached to
+    Nodes with no registered handler go to `default_topic_handler` when set,
+    and are otherwise skipped. Leaf handlers can run inline, in a thread pool
+    or in a process pool (module-level handlers only) and the output tree keeps
+    the order of the input tree.
+    """
+
+    def __init__(self, name, get_key=get_kind, default_topic_handler=None):
+        self.name = name
+        self.get_key = get_key
+        self.default_topic_handler = default_topic_handler
+        self.leaf_handlers = {}
+        self.topic_handlers = {}
+
+    def leaf(self, *keys):
+        def register(handler):
+            for key in keys:
+                self.leaf_handlers[key] = handler
+            return handler
+
+        return register
+
+    def topic(self, *keys):
+        def register(handler):
+            for key in keys:
+                self.topic_handlers[key] = handler
+            return handler
+
+        return register
+
+    def run(self, root, executor="inline", workers=None, **kwargs):
+        """
+        Return the output tree for `root`, running leaf handlers using the
+        `executor` ("inline", "thread" or "process") with `workers` workers.
+        At most 4*workers leaf handler calls are in flight at any time.
+        """
+        workers = workers or os.cpu_count() or 1
+        parent_indices = []  # pre-order index of the parent of each node
+        outputs = []  # list of output nodes for each node, in pre-order
+        pending = collections.deque()
+
+        def collect_leaf():
+            index, key, node, future = pending.popleft()
+            try:
+                outputs[index] = future.result()
+            except Exception:
+                logger.error(
+                    "{} failed on {} node {}".format(self.name, key, node.get("title"))
+                )
+                raise
+
+        with TREE_WALK_EXECUTORS[executor](max_workers=workers) as pool:
+            stack = [(None, root)]
+            while stack:
+                parent_index, node = stack.pop()
+                key = self.get_key(node)
+                index = len(outputs)
+                if key in self.leaf_handlers:
+                    handler = self.leaf_handlers[key]
+                    parent_indices.append(parent_index)
+                    outputs.append([])
+                    future = pool.submit(handler, node, **kwargs)
+                    pending.append((index, key, node, future))
+                    # inline errors surface right away, as in a serial walk
+                    if executor == "inline" or len(pending) >= 4 * workers:
+                        collect_leaf()
+                    continue
+
+                handler = self.topic_handlers.get(key, self.default_topic_handler)
+                if handler is None:
+                    logger.info("{} skipping unknown kind {}".format(self.name, key))
+                    continue
+                topic_node = handler(node)
+                topic_node["children"] = []
+                parent_indices.append(parent_index)
+                outputs.append([topic_node])
+                for child in reversed(node.get("children", [])):
+                    stack.append((index, child))
+
+            while pending:
+                collect_leaf()
+
+        # attaching nodes in pre-order keeps siblings in their original order
+        for index in range(1, len(outputs)):
+            parent_node = outputs[parent_indices[index]][0]
+            parent_node["children"].extend(outputs[index])
+        return outputs[0][0] if outputs and outputs[0] else None
+
+
 # BOX.COM DOWNLOAD HELPERS
 ################################################################################
 
@@ -158,13 +455,30 @@ BOXAPI_FOLDER_DETAILS = "https://api.box.com/2.0/folders/{folder_id}"
 BOXAPI_FOLDER_ITEMS = "https://api.box.com/2.0/folders/{folder_id}/items"
 
 
+def box_api_get(url, shared_link, **kwargs):
+    """
+    GET `url` from the Box.com API using the access token from BOX_CREDENTIALS.
+    If the token is rejected with 401 Unauthorized, it is refreshed and the
+    request is retried once before raising BoxAuthenticationError.
+    """
+    for attempt in range(2):
+        access_token = BOX_CREDENTIALS.get_token()
+        headers = {
+            "Authorization": "Bearer " + access_token,
+            "BoxApi": "shared_link=" + shared_link,
+        }
+        response = requests.get(url, headers=headers, **kwargs)
+        if response.status_code != 401:
+            return response
+        response.close()
+        logger.warning("Box.com rejected access token when getting url=" + url)
+        BOX_CREDENTIALS.invalidate(access_token)
+    raise BoxAuthenticationError("Box.com access token rejected for url=" + url)
+
+
 def get_shared_item(shared_link):
-    headers = {
-        "Authorization": "Bearer " + BOXAPI_DEVELOPER_TOKEN,
-        "BoxApi": "shared_link=" + shared_link,
-    }
     # GET1: get file id for this shared link
-    response1 = requests.get(BOXAPI_SHARED_ITEMS, headers=headers)
+    response1 = box_api_get(BOXAPI_SHARED_ITEMS, shared_link)
     json_data = response1.json()
 
     if response1.status_code == 404:
@@ -182,13 +496,9 @@ def get_shared_item(shared_link):
 
 
 def box_download_file(file_id, shared_link, destdir=DOWNLOADED_FILES_DIR):
-    headers = {
-        "Authorization": "Bearer " + BOXAPI_DEVELOPER_TOKEN,
-        "BoxApi": "shared_link=" + shared_link,
-    }
     # GET2: get actual file data
     box_api_url = BOXAPI_FILES_CONTENT.format(file_id=file_id)
-    response = requests.get(box_api_url, headers=headers, stream=True)
+    response = box_api_get(box_api_url, shared_link, stream=True)
 
     if response.status_code == 200:
         _, params = cgi.parse_header(response.headers["Content-Disposition"])
@@ -221,14 +531,9 @@ def box_download_folder(folder_id, shared_link, destdir=DOWNLOADED_FILES_DIR):
     """
     Return a dict {'title': '',  'children': [ {'path':'local/path/to/file.pdf'}]  }
     """
-    headers = {
-        "Authorization": "Bearer " + BOXAPI_DEVELOPER_TOKEN,
-        "BoxApi": "shared_link=" + shared_link,
-    }
-
     # Get deets
-    response1 = requests.get(
-        BOXAPI_FOLDER_DETAILS.format(folder_id=folder_id), headers=headers
+    response1 = box_api_get(
+        BOXAPI_FOLDER_DETAILS.format(folder_id=folder_id), shared_link
     )
     folder_data = response1.json()
     folder_name = folder_data["name"]
@@ -240,8 +545,8 @@ def box_download_folder(folder_id, shared_link, destdir=DOWNLOADED_FILES_DIR):
         os.mkdir(folder_path)
 
     # Get contents
-    response2 = requests.get(
-        BOXAPI_FOLDER_ITEMS.format(folder_id=folder_id), headers=headers
+    response2 = box_api_get(
+        BOXAPI_FOLDER_ITEMS.format(folder_id=folder_id), shared_link
     )
     json_data = response2.json()
     for entry in json_data["entries"]:
@@ -275,9 +580,6 @@ def box_download_folder(folder_id, shared_link, destdir=DOWNLOADED_FILES_DIR):
 # CRAWLING
 #################################################################################
 
-# Map of vimeo videos that have been used
-USED_VIMEO_VIDEOS = {}
-
 
 def crawl_shls(start_url):
     _, page = download_page(start_url)
@@ -455,96 +757,111 @@ def download_vimeo_playlist(playlist_url, title):
 ################################################################################
 
 
-def scrape_shls():
-    logger.info("scraping")
-    with open(CRAWLING_STAGE_OUTPUT, "r") as inf:
-        web_resource_tree = json.load(inf)
-
-    downloaded_resources = {}
+SCRAPE_STAGE = TreeStage("scrape", default_topic_handler=copy_topic_node)
 
-    def scrape_subtree(subtree):
 
-        # recurse down the tree, creating a new subtree
-        oldchildren = subtree["children"] if "children" in subtree else []
-        subtree["children"] = []
-        for child in oldchildren:
-
-            child_title = child["title"]
-
-            child_kind = child["kind"]
-            logger.info("scraping", child_kind, " title = ", child_title)
-
-            # Scrape links
-            if child_kind == "shls_link":
-                child_url = child["url"]
-
-                if "for print" in child_title:
-                    continue
-                if "for web" in child_title:
-                    child_title = child_title.replace(" for web", "")
-                if "rescue.box.com" in child_url:
-                    shared_link = child_url
-                    shared_item = get_shared_item(shared_link)
-                    if not shared_item:
-                        logger.warning("Not found on Box.com: {}".format(shared_link))
-                        logger.info("Skipping", child_title, "child_url=", child_url)
-                        continue
-                    shared_type, folder_id, file_id = shared_item
-
-                    if shared_type == "file":
-                        path = box_download_file(
-                            file_id, shared_link, destdir=DOWNLOADED_FILES_DIR
-                        )
-
-                        if not path:
-                            logger.info("Skipping", child_title, "child_url=", child_url)
-                            continue
-
-                        del child["url"]
-                        child["path"] = path
-                        child["kind"] = "shls_link"
-                        child["source_id"] = "box_file:" + file_id
-                        subtree["children"].append(child)
-
-                    elif shared_type == "folder":
-                        child_subtree = box_download_folder(folder_id, shared_link)
-                        child_subtree["kind"] = "shls_shared_folder"
-                        subtree["children"].append(child_subtree)
-
-                elif "vimeo.com" in child_url:
-                    if child_url not in USED_VIMEO_VIDEOS:
-                        USED_VIMEO_VIDEOS[child_url] = [child_title]
-                    else:
-                        USED_VIMEO_VIDEOS[child_url].append(child_title)
-                        logger.info(
-                            "Duplicate reference to: {} - from:\n{}\n\n".format(
-                                child_url, "\n".join(USED_VIMEO_VIDEOS[child_url])
-                            )
-                        )
-                        logger.info("Skipping", child_title, "child_url=", child_url)
-                        continue
-
-                    if child_title.endswith("_ENGLISH"):
-                        lang = "en"
-                    if child_title.endswith("_ARABIC"):
-                        lang = "ar"
-                    playlist_subtree = download_vimeo_playlist(child_url, child_title)
-                    playlist_subtree["language"] = lang
-                    subtree["children"].append(playlist_subtree)
-
-                else:
-                    logger.info("Skipping", child_title, "child_url=", child_url)
-
-            else:
-                # recurse for all non-leaf nodes
-                newchild = scrape_subtree(child)
-                subtree["children"].append(newchild)
-
-        return subtree
+def skip_duplicate_vimeo_links(web_resource_tree):
+    """
+    Remove the links to vimeo playlists that were already linked from earlier
+    in the tree, so that each playlist is scraped only once. Duplicates are
+    only looked for within `web_resource_tree`, so each shard is deduplicated
+    on its own and `merge_shards` handles playlists shared across shards.
+    """
+    # Map of vimeo videos that have been used
+    used_vimeo_videos = {}
+    for parent, child in iter_tree(web_resource_tree):
+        child_url = child.get("url", "")
+        if child.get("kind") != "shls_link" or "for print" in child["title"]:
+            continue
+        if "rescue.box.com" in child_url or "vimeo.com" not in child_url:
+            continue
+        child_title = child["title"].replace(" for web", "")
+        if child_url not in used_vimeo_videos:
+            used_vimeo_videos[child_url] = [child_title]
+        else:
+            used_vimeo_videos[child_url].append(child_title)
+            logger.info(
+                "Duplicate reference to: {} - from:\n{}\n\n".format(
+                    child_url, "\n".join(used_vimeo_videos[child_url])
+                )
+            )
+            logger.info("Skipping", child_title, "child_url=", child_url)
+            parent["children"] = [c for c in parent["children"] if c is not child]
+
+
+@SCRAPE_STAGE.leaf("shls_link")
+def scrape_link(child, downloaded_dir=DOWNLOADED_FILES_DIR):
+    child_title = child["title"]
+    child_url = child["url"]
+    logger.info("scraping", child["kind"], " title = ", child_title)
+
+    if "for print" in child_title:
+        return []
+    if "for web" in child_title:
+        child_title = child_title.replace(" for web", "")
+    if "rescue.box.com" in child_url:
+        shared_link = child_url
+        shared_item = get_shared_item(shared_link)
+        if not shared_item:
+            logger.warning("Not found on Box.com: {}".format(shared_link))
+            logger.info("Skipping", child_title, "child_url=", child_url)
+            return []
+        shared_type, folder_id, file_id = shared_item
+
+        if shared_type == "file":
+            path = box_download_file(file_id, shared_link, destdir=downloaded_dir)
+
+            if not path:
+                logger.info("Skipping", child_title, "child_url=", child_url)
+                return []
+
+            del child["url"]
+            child["path"] = path
+            child["kind"] = "shls_link"
+            child["source_id"] = "box_file:" + file_id
+            return [child]
+
+        elif shared_type == "folder":
+            child_subtree = box_download_folder(
+                folder_id, shared_link, destdir=downloaded_dir
+            )
+            child_subtree["kind"] = "shls_shared_folder"
+            return [child_subtree]
+
+    elif "vimeo.com" in child_url:
+        if child_title.endswith("_ENGLISH"):
+            lang = "en"
+        if child_title.endswith("_ARABIC"):
+            lang = "ar"
+        playlist_subtree = download_vimeo_playlist(child_url, child_title)
+        playlist_subtree["language"] = lang
+        playlist_subtree["url"] = child_url
+        return [playlist_subtree]
+
+    logger.info("Skipping", child_title, "child_url=", child_url)
+    return []
+
+
+def scrape_shls(
+    input_path=CRAWLING_STAGE_OUTPUT,
+    output_path=SCRAPING_STAGE_OUTPUT,
+    downloaded_dir=DOWNLOADED_FILES_DIR,
+    executor="inline",
+    workers=None,
+):
+    logger.info("scraping")
+    with open(input_path, "r") as inf:
+        web_resource_tree = json.load(inf)
 
-    downloaded_resources = scrape_subtree(web_resource_tree)
+    skip_duplicate_vimeo_links(web_resource_tree)
+    downloaded_resources = SCRAPE_STAGE.run(
+        web_resource_tree,
+        executor=executor,
+        workers=workers,
+        downloaded_dir=downloaded_dir,
+    )
 
-    with open(SCRAPING_STAGE_OUTPUT, "w") as outf:
+    with open(output_path, "w") as outf:
         json.dump(downloaded_resources, outf, indent=2)
     return downloaded_resources
 
@@ -583,73 +900,368 @@ def convert_file_to_pdf(path, dest_path):
     save_response_content(response, dest_path)
 
 
-def transform_local_files():
+def get_transform_key(node):
+    return "file" if node.get("path", None) is not None else node.get("kind")
+
+
+TRANSFORM_STAGE = TreeStage(
+    "transform", get_key=get_transform_key, default_topic_handler=copy_topic_node
+)
+
+
+@TRANSFORM_STAGE.leaf("file")
+def transform_file(
+    child, downloaded_dir=DOWNLOADED_FILES_DIR, transformed_dir=TRANSFORMED_FILES_DIR
+):
+    """
+    Move files from downloade/ to transformed/ folder, convering file formats
+    in the process (.xlxs, .docx, .pptx) --> .pdf
+    """
+    logger.info("transforming title = ", child["title"])
+    path = child["path"]
+    path_pre_ext, path_ext = os.path.splitext(path)
+    if path_ext == ".pdf":
+        logger.info("Copying pdf file", path)
+        dest_path = path.replace(downloaded_dir, transformed_dir)
+        dest_dir = os.path.dirname(dest_path)
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir, exist_ok=True)
+        shutil.copy(path, dest_path)
+        child["path"] = dest_path
+        return [child]
+    elif path_ext in [".docx", ".xlsx", ".pptx"]:
+        dest_path = path_pre_ext.replace(downloaded_dir, transformed_dir) + ".pdf"
+        if not os.path.exists(dest_path):
+            logger.info("COnverting", path, "to PDF")
+            dest_dir = os.path.dirname(dest_path)
+            if not os.path.exists(dest_dir):
+                os.makedirs(dest_dir, exist_ok=True)
+            convert_file_to_pdf(path, dest_path)
+        child["path"] = dest_path
+        return [child]
+
+    logger.info("Skipping file", path)
+    return []
+
+
+def transform_local_files(
+    input_path=SCRAPING_STAGE_OUTPUT,
+    output_path=TRANSFORMED_STAGE_OUTPUT,
+    downloaded_dir=DOWNLOADED_FILES_DIR,
+    transformed_dir=TRANSFORMED_FILES_DIR,
+    executor="inline",
+    workers=None,
+):
     logger.info("transforming downloaded resources")
-    with open(SCRAPING_STAGE_OUTPUT, "r") as inf:
+    with open(input_path, "r") as inf:
         downloaded_resources = json.load(inf)
 
-    transformed_resources = {}
+    transformed_resources = TRANSFORM_STAGE.run(
+        downloaded_resources,
+        executor=executor,
+        workers=workers,
+        downloaded_dir=downloaded_dir,
+        transformed_dir=transformed_dir,
+    )
+    transformed_resources["kind"] = "transformed_resources_tree"
 
-    def transform_subtree(subtree):
-        """
-        Move files from downloade/ to transformed/ folder, convering file formats
-        in the process (.xlxs, .docx, .pptx) --> .pdf
-        """
-        oldchildren = subtree["children"] if "children" in subtree else []
-        subtree["children"] = []
-        for child in oldchildren:
-            child_title = child["title"]
-            logger.info("transforming title = ", child_title)
-
-            path = child.get("path", None)
-
-            if path is not None:
-                path_pre_ext, path_ext = os.path.splitext(path)
-                if path_ext == ".pdf":
-                    logger.info("Copying pdf file", path)
-                    dest_path = path.replace(
-                        DOWNLOADED_FILES_DIR, TRANSFORMED_FILES_DIR
-                    )
-                    dest_dir = os.path.dirname(dest_path)
-                    if not os.path.exists(dest_dir):
-                        os.makedirs(dest_dir, exist_ok=True)
-                    shutil.copy(path, dest_path)
-                    child["path"] = dest_path
-                    subtree["children"].append(child)
-                elif path_ext in [".docx", ".xlsx", ".pptx"]:
-                    dest_path = (
-                        path_pre_ext.replace(
-                            DOWNLOADED_FILES_DIR, TRANSFORMED_FILES_DIR
-                        )
-                        + ".pdf"
-                    )
-                    if not os.path.exists(dest_path):
-                        logger.info("COnverting", path, "to PDF")
-                        dest_dir = os.path.dirname(dest_path)
-                        if not os.path.exists(dest_dir):
-                            os.makedirs(dest_dir, exist_ok=True)
-                        convert_file_to_pdf(path, dest_path)
-                    child["path"] = dest_path
-                    subtree["children"].append(child)
+    with open(output_path, "w") as outf:
+        json.dump(transformed_resources, outf, indent=2)
+    return transformed_resources
 
-                else:
-                    logger.info("Skipping file", path)
 
-            else:
-                # recurse for all non-leaf nodes
-                newchild = transform_subtree(child)
-                subtree["children"].append(newchild)
+# SHARDING
+################################################################################
 
-        return subtree
+SHARDS_DIR = "chefdata/shards"
+SHARDS_MANIFEST = os.path.join(SHARDS_DIR, "manifest.json")
+SHARD_PLACEHOLDER_KIND = "shls_shard"
 
-    transformed_resources = transform_subtree(downloaded_resources)
-    transformed_resources["kind"] = "transformed_resources_tree"
+
+def get_shard_paths(shard_dir):
+    """
+    Return the dict of stage outputs and data directories used by a shard.
+    """
+    return dict(
+        crawl=os.path.join(shard_dir, "shls_web_resource_tree.json"),
+        scrape=os.path.join(shard_dir, "shls_downloaded_resources.json"),
+        transform=os.path.join(shard_dir, "shls_transformed_resources.json"),
+        downloaded_dir=os.path.join(shard_dir, "downloaded"),
+        transformed_dir=os.path.join(shard_dir, "transformed"),
+    )
+
+
+def plan_shards(shard_kind="shls_subject"):
+    """
+    Split the crawling stage output into shards that can be scraped and
+    transformed independently, one for each node of kind `shard_kind`.
+    Shard nodes are replaced by placeholders in the remaining tree, which is
+    saved as shard 0 so that top-level links (e.g. the brochure) still get
+    processed. Returns the list of shard directories.
+    """
+    with open(CRAWLING_STAGE_OUTPUT, "r") as inf:
+        skeleton = json.load(inf)
+
+    shard_trees = [skeleton]
+    stack = [skeleton]
+    while stack:
+        subtree = stack.pop()
+        children = subtree.get("children", [])
+        for i, child in enumerate(children):
+            if child.get("kind") == shard_kind:
+                children[i] = dict(
+                    kind=SHARD_PLACEHOLDER_KIND,
+                    title=child["title"],
+                    shard=len(shard_trees),
+                )
+                shard_trees.append(dict(title=child["title"], children=[child]))
+        stack.extend(reversed(children))
+
+    shard_dirs = []
+    for i, shard_tree in enumerate(shard_trees):
+        shard_dir = os.path.join(SHARDS_DIR, "shard_{:03d}".format(i))
+        os.makedirs(shard_dir, exist_ok=True)
+        with open(get_shard_paths(shard_dir)["crawl"], "w") as outf:
+            json.dump(shard_tree, outf, indent=2)
+        shard_dirs.append(shard_dir)
+
+    manifest = dict(shard_kind=shard_kind, shards=shard_dirs)
+    with open(SHARDS_MANIFEST, "w") as outf:
+        json.dump(manifest, outf, indent=2)
+    logger.info("Planned {} shards by kind={}".format(len(shard_dirs), shard_kind))
+    return shard_dirs
+
+
+def run_shard(shard_dir, executor="inline", workers=None):
+    """
+    Run the scrape and transform stages for the shard in `shard_dir`, walking
+    the shard tree with the given `executor` and `workers`.
+    """
+    paths = get_shard_paths(shard_dir)
+    for dir in [paths["downloaded_dir"], paths["transformed_dir"]]:
+        if not os.path.exists(dir):
+            os.makedirs(dir, exist_ok=True)
+    logger.info("Running shard {}".format(shard_dir))
+    scrape_shls(
+        input_path=paths["crawl"],
+        output_path=paths["scrape"],
+        downloaded_dir=paths["downloaded_dir"],
+        executor=executor,
+        workers=workers,
+    )
+    transform_local_files(
+        input_path=paths["scrape"],
+        output_path=paths["transform"],
+        downloaded_dir=paths["downloaded_dir"],
+        transformed_dir=paths["transformed_dir"],
+        executor=executor,
+        workers=workers,
+    )
+    return shard_dir
+
+
+def run_shards(shard_dirs, executor="inline", workers=None):
+    """
+    Run all shards in `shard_dirs` in a pool of `workers` processes. Each shard
+    walks its tree with `executor`; since shards already run in worker
+    processes, "process" is replaced by "thread" inside them.
+    """
+    if executor == "process":
+        logger.info("Using executor=thread inside shard processes")
+        executor = "thread"
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(run_shard, shard_dir, executor=executor, workers=workers)
+            for shard_dir in shard_dirs
+        ]
+        for future in futures:
+            logger.info("Finished shard {}".format(future.result()))
+
+
+def merge_shards():
+    """
+    Rebuild the transform stage output from the per-shard outputs listed in the
+    shards manifest, splicing each shard into its placeholder so the merged tree
+    has the same order as the unsharded run. Vimeo playlists referenced from
+    several shards are kept only at their first position, as in `scrape_shls`.
+    """
+    with open(SHARDS_MANIFEST, "r") as inf:
+        manifest = json.load(inf)
+    shard_dirs = manifest["shards"]
+
+    def load_shard(shard_index):
+        shard_output = get_shard_paths(shard_dirs[shard_index])["transform"]
+        with open(shard_output, "r") as inf:
+            return json.load(inf)
+
+    transformed_resources = load_shard(0)
+    used_playlists = set()
+
+    # iterative pre-order walk; siblings are pushed reversed to keep their order
+    stack = [(None, transformed_resources)]
+    while stack:
+        parent, node = stack.pop()
+        kind = node.get("kind")
+        if kind == SHARD_PLACEHOLDER_KIND:
+            shard_tree = load_shard(node["shard"])
+            for child in reversed(shard_tree["children"]):
+                stack.append((parent, child))
+            continue
+        if kind == "vimeo_playlist" and "url" in node:
+            if node["url"] in used_playlists:
+                logger.info("Skipping duplicate playlist {}".format(node["url"]))
+                continue
+            used_playlists.add(node["url"])
+        if parent is not None:
+            parent["children"].append(node)
+        if "children" in node:
+            children = node["children"]
+            node["children"] = []
+            for child in reversed(children):
+                stack.append((node, child))
 
     with open(TRANSFORMED_STAGE_OUTPUT, "w") as outf:
         json.dump(transformed_resources, outf, indent=2)
     return transformed_resources
 
 
+# OPTIMIZE
+################################################################################
+
+OPTIMIZED_FILES_DIR = "chefdata/optimized"
+OPTIMIZED_FILES_INDEX = os.path.join(OPTIMIZED_FILES_DIR, "index.json")
+GHOSTSCRIPT_CMD = [
+    "gs",
+    "-sDEVICE=pdfwrite",
+    "-dPDFSETTINGS=/ebook",  # downsample images to 150 dpi
+    "-dDetectDuplicateImages=true",
+    "-dCompressFonts=true",
+    "-dCompatibilityLevel=1.5",
+    "-dNOPAUSE",
+    "-dBATCH",
+    "-dQUIET",
+]
+QPDF_CMD = ["qpdf", "--linearize", "--object-streams=generate"]
+QPDF_EXIT_WARNINGS = 3  # qpdf succeeded but reported problems in the input
+PDF_TOOLS_TIMEOUT = 10 * 60
+
+
+def run_pdf_tools(path, input_size):
+    """
+    Run ghostscript then qpdf on `path`, store the result in OPTIMIZED_FILES_DIR
+    and return (output_hash, cached_path), or (None, None) if the result is not
+    smaller than the original. Raises CalledProcessError or TimeoutExpired when
+    one of the tools fails.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        downsampled_path = os.path.join(tmpdir, "downsampled.pdf")
+        linearized_path = os.path.join(tmpdir, "linearized.pdf")
+        subprocess.run(
+            GHOSTSCRIPT_CMD + ["-sOutputFile=" + downsampled_path, path],
+            check=True,
+            timeout=PDF_TOOLS_TIMEOUT,
+        )
+        # keep the original contents if ghostscript made the file bigger
+        if os.path.getsize(downsampled_path) >= input_size:
+            downsampled_path = path
+        qpdf_cmd = QPDF_CMD + [downsampled_path, linearized_path]
+        process = subprocess.run(qpdf_cmd, timeout=PDF_TOOLS_TIMEOUT)
+        if process.returncode not in [0, QPDF_EXIT_WARNINGS]:
+            raise subprocess.CalledProcessError(process.returncode, qpdf_cmd)
+        # linearization adds hint tables, so it can also make the file bigger
+        if os.path.getsize(linearized_path) >= input_size:
+            return None, None
+        output_hash = get_file_hash(linearized_path)
+        cached_path = os.path.join(OPTIMIZED_FILES_DIR, output_hash + ".pdf")
+        shutil.move(linearized_path, cached_path)
+    return output_hash, cached_path
+
+
+def optimize_pdf(path, index):
+    """
+    Shrink the PDF file at `path` in place: downsample images and deduplicate
+    objects with ghostscript, then linearize the result with qpdf. Optimized
+    files are stored in OPTIMIZED_FILES_DIR by content hash, and `index` maps
+    hashes of input files to the hash of their optimized version. If the tools
+    fail, the original file is kept and output_hash is None.
+    Returns (path, input_hash, output_hash, input_size, output_size).
+    """
+    input_hash = get_file_hash(path)
+    input_size = os.path.getsize(path)
+    if input_hash in index.values():
+        logger.debug("Skipping {}, already optimized".format(path))
+        return path, input_hash, input_hash, input_size, input_size
+
+    cached_path = None
+    if input_hash in index:
+        output_hash = index[input_hash]
+        cached_path = os.path.join(OPTIMIZED_FILES_DIR, output_hash + ".pdf")
+        if not os.path.exists(cached_path):
+            logger.warning("Cached optimized file missing for {}".format(path))
+            cached_path = None
+
+    if cached_path is None:
+        try:
+            output_hash, cached_path = run_pdf_tools(path, input_size)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            logger.error("Could not optimize {}, keeping original: {}".format(path, e))
+            return path, input_hash, None, input_size, input_size
+        if output_hash is None:
+            logger.info("Keeping {}, optimizing did not make it smaller".format(path))
+            return path, input_hash, input_hash, input_size, input_size
+
+    shutil.copy(cached_path, path)
+    return path, input_hash, output_hash, input_size, os.path.getsize(path)
+
+
+def optimize_transformed_pdfs(workers=None):
+    """
+    Run `optimize_pdf` in a process pool on all the PDF files referenced from
+    the transform stage output and report the bytes saved for each file.
+    """
+    missing_tools = [cmd[0] for cmd in [GHOSTSCRIPT_CMD, QPDF_CMD]]
+    missing_tools = [tool for tool in missing_tools if shutil.which(tool) is None]
+    if missing_tools:
+        logger.warning(
+            "Skipping PDF optimization, missing {}".format(", ".join(missing_tools))
+        )
+        return
+
+    logger.info("optimizing transformed PDFs")
+    with open(TRANSFORMED_STAGE_OUTPUT, "r") as inf:
+        transformed_resources = json.load(inf)
+    if not os.path.exists(OPTIMIZED_FILES_DIR):
+        os.makedirs(OPTIMIZED_FILES_DIR, exist_ok=True)
+    index = {}
+    if os.path.exists(OPTIMIZED_FILES_INDEX):
+        with open(OPTIMIZED_FILES_INDEX, "r") as inf:
+            index = json.load(inf)
+
+    paths = []
+    for _, subtree in iter_tree(transformed_resources):
+        path = subtree.get("path", None)
+        if path is not None and path.endswith(".pdf") and path not in paths:
+            paths.append(path)
+
+    total_saved = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(optimize_pdf, paths, [index] * len(paths))
+        for path, input_hash, output_hash, input_size, output_size in results:
+            if output_hash is not None:
+                index[input_hash] = output_hash
+            saved = input_size - output_size
+            total_saved += saved
+            logger.info("Optimized {} saved {} bytes".format(path, saved))
+
+    with open(OPTIMIZED_FILES_INDEX, "w") as outf:
+        json.dump(index, outf, indent=2)
+    logger.info(
+        "Optimized {} PDFs, saved {:.1f} MB in total".format(
+            len(paths), total_saved / 1024.0 / 1024.0
+        )
+    )
+
+
 # LOAD
 ################################################################################
 
@@ -664,75 +1276,191 @@ TOPIC_LIKE_KINDS = [
 ]
 
 
-def create_ricecooker_json_tree(channel_info):
-    logger.info("Creating ricecooker json tree")
-    with open(TRANSFORMED_STAGE_OUTPUT, "r") as inf:
-        transformed_resources = json.load(inf)
+LOAD_STAGE = TreeStage("load")
 
-    def ricecookerify_subtree(subtree):
-        kind = subtree["kind"]
-        if kind in TOPIC_LIKE_KINDS:
-            topic_node = dict(
-                kind=content_kinds.TOPIC,
-                source_id=subtree.get("source_id", subtree["title"]),
-                title=subtree["title"],
-                description=subtree.get("description", None),
-                thumbnail=subtree.get("thumbnail", None),
-                license=SHLS_LICENSE_DICT,
-                language="en",  # TODO(set correctly)
-                children=[],
-            )
-            for child in subtree["children"]:
-                child_node = ricecookerify_subtree(child)
-                topic_node["children"].append(child_node)
-            return topic_node
-
-        elif kind == "vimeo_video":
-            video_node = dict(
-                kind=content_kinds.VIDEO,
-                source_id=subtree["web_url"],
-                language="en",  # TODO(set correctly)
-                title=subtree["title"],
-                description=subtree.get("description", ""),
-                thumbnail=subtree["thumbnail"],
-                license=SHLS_LICENSE_DICT,
-                files=[],
-            )
-            video_file = dict(
-                file_type=file_types.VIDEO,
-                web_url=subtree["web_url"],
-                language="en",  # TODO(set correctly)
-            )
-            video_node["files"].append(video_file)
-            return video_node
-
-        elif kind == "shls_link":
-            document_node = dict(
-                kind=content_kinds.DOCUMENT,
-                source_id=subtree["source_id"],
-                language="en",  # TODO(set correctly)
-                title=subtree["title"],
-                description=subtree.get("description", ""),
-                thumbnail=subtree.get("thumbnail", None),
-                license=SHLS_LICENSE_DICT,
-                files=[],
-            )
-            document_file = dict(
-                file_type=file_types.DOCUMENT,
-                path=subtree["path"],
-                language="en",  # TODO(set correctly)
-            )
-            document_node["files"].append(document_file)
-            return document_node
 
-        else:
-            logger.info("UNKNOWN kind", kind, subtree)
+@LOAD_STAGE.topic(*TOPIC_LIKE_KINDS)
+def ricecookerify_topic(subtree):
+    return dict(
+        kind=content_kinds.TOPIC,
+        source_id=subtree.get("source_id", subtree["title"]),
+        title=subtree["title"],
+        description=subtree.get("description", None),
+        thumbnail=subtree.get("thumbnail", None),
+        license=SHLS_LICENSE_DICT,
+        language="en",  # TODO(set correctly)
+        children=[],
+    )
+
+
+@LOAD_STAGE.leaf("vimeo_video")
+def ricecookerify_video(subtree):
+    video_node = dict(
+        kind=content_kinds.VIDEO,
+        source_id=subtree["web_url"],
+        language="en",  # TODO(set correctly)
+        title=subtree["title"],
+        description=subtree.get("description", ""),
+        thumbnail=subtree["thumbnail"],
+        license=SHLS_LICENSE_DICT,
+        files=[],
+    )
+    video_file = dict(
+        file_type=file_types.VIDEO,
+        web_url=subtree["web_url"],
+        language="en",  # TODO(set correctly)
+    )
+    video_node["files"].append(video_file)
+    return [video_node]
+
+
+@LOAD_STAGE.leaf("shls_link")
+def ricecookerify_document(subtree):
+    document_node = dict(
+        kind=content_kinds.DOCUMENT,
+        source_id=subtree["source_id"],
+        language="en",  # TODO(set correctly)
+        title=subtree["title"],
+        description=subtree.get("description", ""),
+        thumbnail=subtree.get("thumbnail", None),
+        license=SHLS_LICENSE_DICT,
+        files=[],
+    )
+    document_file = dict(
+        file_type=file_types.DOCUMENT,
+        path=subtree["path"],
+        language="en",  # TODO(set correctly)
+    )
+    document_node["files"].append(document_file)
+    return [document_node]
 
-    ricecooker_json_tree = ricecookerify_subtree(transformed_resources)
+
+def create_ricecooker_json_tree(
+    channel_info,
+    input_path=TRANSFORMED_STAGE_OUTPUT,
+    executor="inline",
+    workers=None,
+):
+    logger.info("Creating ricecooker json tree")
+    with open(input_path, "r") as inf:
+        transformed_resources = json.load(inf)
+
+    ricecooker_json_tree = LOAD_STAGE.run(
+        transformed_resources, executor=executor, workers=workers
+    )
     ricecooker_json_tree.update(channel_info)
     return ricecooker_json_tree
 
 
+# PREFLIGHT
+################################################################################
+
+PREFLIGHT_CACHE = "chefdata/preflight_cache.json"
+PDF_MAGIC = b"%PDF-"
+PDF_TRAILER = b"%%EOF"
+PDF_TRAILER_WINDOW = 1024  # the %%EOF marker must be within the last 1024 bytes
+
+
+def check_pdf_file(path, cache):
+    """
+    Check that `path` is a non-empty, complete PDF file with at least one page.
+    The `cache` dict maps content hashes of previously checked files to their
+    page count, so files that have already passed are only hashed.
+    Encrypted PDFs that open without a password but can't be decrypted here
+    (e.g. AES owner-password-only exports) get a warning instead of an error.
+    Returns (content_hash, num_pages, error, warning) where error is None on
+    success.
+    """
+    if not os.path.exists(path):
+        return None, None, "missing file", None
+    size = os.path.getsize(path)
+    if size == 0:
+        return None, None, "empty file", None
+
+    content_hash = get_file_hash(path)
+    if content_hash in cache:
+        return content_hash, cache[content_hash], None, None
+
+    with open(path, "rb") as inf:
+        header = inf.read(len(PDF_MAGIC))
+        inf.seek(max(0, size - PDF_TRAILER_WINDOW))
+        tail = inf.read()
+    if header != PDF_MAGIC:
+        return content_hash, None, "not a PDF (header={})".format(header), None
+    if PDF_TRAILER not in tail:
+        return content_hash, None, "truncated PDF (no %%EOF trailer)", None
+    try:
+        with open(path, "rb") as inf:
+            reader = PdfFileReader(inf, strict=False)
+            if reader.isEncrypted:
+                try:
+                    decrypted = reader.decrypt("")
+                except Exception as e:
+                    warning = "encrypted PDF, page count not checked ({})".format(e)
+                    return content_hash, None, None, warning
+                if not decrypted:
+                    return content_hash, None, "PDF needs a password to open", None
+            num_pages = reader.getNumPages()
+    except Exception as e:
+        return content_hash, None, "unreadable PDF ({})".format(e), None
+    if num_pages == 0:
+        return content_hash, num_pages, "PDF has no pages", None
+    return content_hash, num_pages, None, None
+
+
+def preflight_json_tree(json_tree_path, workers=None):
+    """
+    Check every document file in the ricecooker json tree at `json_tree_path`
+    using a thread pool, and raise PreflightError listing all the problems found
+    so the run stops before anything gets uploaded.
+    """
+    logger.info("Running preflight checks on {}".format(json_tree_path))
+    with open(json_tree_path, "r") as inf:
+        ricecooker_json_tree = json.load(inf)
+
+    cache = {}
+    if os.path.exists(PREFLIGHT_CACHE):
+        with open(PREFLIGHT_CACHE, "r") as inf:
+            cache = json.load(inf)
+
+    # collect (title, path) of all document files in tree order
+    documents = []
+    for _, node in iter_tree(ricecooker_json_tree):
+        for file_dict in node.get("files", []):
+            if file_dict["file_type"] == file_types.DOCUMENT:
+                documents.append((node["title"], file_dict["path"]))
+
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        paths = [path for _, path in documents]
+        results = executor.map(check_pdf_file, paths, [cache] * len(paths))
+        for (title, path), result in zip(documents, results):
+            content_hash, num_pages, error, warning = result
+            if error:
+                failures.append((title, path, error))
+            elif warning:
+                logger.warning(
+                    "Preflight warning for {} path={}: {}".format(title, path, warning)
+                )
+            else:
+                cache[content_hash] = num_pages
+
+    with open(PREFLIGHT_CACHE, "w") as outf:
+        json.dump(cache, outf, indent=2)
+
+    if failures:
+        for title, path, error in failures:
+            logger.error(
+                "Preflight failed for {} path={}: {}".format(title, path, error)
+            )
+        raise PreflightError(
+            "{} of {} documents failed preflight checks".format(
+                len(failures), len(documents)
+            )
+        )
+    logger.info("Preflight checks passed for {} documents".format(len(documents)))
+
+
 # CHEF
 ################################################################################
 
@@ -746,10 +1474,18 @@ class SHLSChef(JsonTreeChef):
         crawl_shls(SHLS_START_URL)
 
     def scrape(self, args, options):
-        scrape_shls()
+        workers = int(options["workers"]) if "workers" in options else None
+        scrape_shls(executor=options.get("executor", "inline"), workers=workers)
 
     def transform(self, args, options):
-        transform_local_files()
+        workers = int(options["workers"]) if "workers" in options else None
+        transform_local_files(
+            executor=options.get("executor", "inline"), workers=workers
+        )
+
+    def optimize(self, args, options):
+        workers = int(options["workers"]) if "workers" in options else None
+        optimize_transformed_pdfs(workers=workers)
 
     def write_json_tree(self, args, options):
         channel_info = {
@@ -764,15 +1500,66 @@ class SHLSChef(JsonTreeChef):
         json_tree_path = self.get_json_tree_path()
         write_tree_to_json_tree(json_tree_path, ricecooker_json_tree)
 
+    def preflight(self, args, options):
+        workers = int(options["workers"]) if "workers" in options else None
+        preflight_json_tree(self.get_json_tree_path(), workers=workers)
+
+    def run_sharded(self, args, options):
+        """
+        Run the scrape and transform stages split into shards. The `shard_stage`
+        option selects what this invocation does, so shards can also be spread
+        across machines that share (or copy back) the `chefdata/shards` folder:
+          - `all` (default): plan, run shards in `workers` processes, and merge
+          - `plan`: crawl and write the shard inputs, then exit
+          - `run`: run the single shard number `shard`, then exit
+          - `merge`: merge the shard outputs and continue with the upload
+        """
+        shard_stage = options.get("shard_stage", "all")
+        executor = options.get("executor", "inline")
+        workers = int(options["workers"]) if "workers" in options else None
+        if shard_stage in ["all", "plan"]:
+            self.crawl(args, options)
+            shard_dirs = plan_shards(
+                shard_kind=options.get("shard_by", "shls_subject")
+            )
+            if shard_stage == "plan":
+                sys.exit(0)
+            run_shards(shard_dirs, executor=executor, workers=workers)
+        elif shard_stage == "run":
+            if "shard" not in options:
+                raise ValueError("shard_stage=run needs the shard number, e.g. shard=0")
+            with open(SHARDS_MANIFEST, "r") as inf:
+                manifest = json.load(inf)
+            shard_index = int(options["shard"])
+            if not 0 <= shard_index < len(manifest["shards"]):
+                raise ValueError(
+                    "shard={} is out of range, the manifest has {} shards".format(
+                        shard_index, len(manifest["shards"])
+                    )
+                )
+            run_shard(
+                manifest["shards"][shard_index], executor=executor, workers=workers
+            )
+            sys.exit(0)
+        elif shard_stage != "merge":
+            raise ValueError("Unknown shard_stage {}".format(shard_stage))
+        merge_shards()
+
     def pre_run(self, args, options):
         data_dirs = [TREES_DATA_DIR, DOWNLOADED_FILES_DIR, TRANSFORMED_FILES_DIR]
         for dir in data_dirs:
             if not os.path.exists(dir):
                 os.makedirs(dir, exist_ok=True)
-        self.crawl(args, options)
-        self.scrape(args, options)
-        self.transform(args, options)
+        if "shard_by" in options or "shard_stage" in options:
+            self.run_sharded(args, options)
+        else:
+            self.crawl(args, options)
+            self.scrape(args, options)
+            self.transform(args, options)
+        if options.get("optimize_pdfs", "0").lower() in ["1", "true", "yes"]:
+            self.optimize(args, options)
         self.write_json_tree(args, options)
+        self.preflight(args, options)
 
 
 # CLI